@@ -1,42 +1,42 @@
 import re
-import json
-import MeCab
-import time
+import functools
+import fugashi
+import orjson
 import sys
 import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from yomigami_utils import kata_to_hira, parse_tokens
 
 # --- 配置 ---
 DATA_FOLDER = "aozorabunko_text-master/cards"
 MAX_BOOKS_TO_PROCESS = 100 
+OUTPUT_FILE = "corpus_raw.jsonl"  # 每行一个句子
+TOKENIZE_CACHE_SIZE = 200_000  # MeCab 分词结果的 LRU 缓存条数
 
 # Aozora 格式的正则表达式
-RE_ANNOTATION = re.compile(r'［＃.*?］')
 RE_SEPARATOR = re.compile(r'^-{5,}.*?$', re.MULTILINE)
+# 注释 ［＃...］ 可能夹在 ruby 的汉字与读音之间 (例如外字 ※［＃...］《よみ》)，
+# 所以必须先去掉注释再匹配 ruby
+RE_ANNOTATION = re.compile(r'［＃.*?］')
 RE_RUBY = re.compile(r'｜?([^《]+?)《(.+?)》')
 
-def kata_to_hira(katakana_string):
-    """将片假名字符串转换为平假名"""
-    hiragana = []
-    for char in katakana_string:
-        code = ord(char)
-        if 12449 <= code <= 12534: 
-            hiragana.append(chr(code - 96)) 
-        else:
-            hiragana.append(char)
-    return "".join(hiragana)
-
 class AozoraParser:
     def __init__(self):
         try:
             # !!! 最终升级：使用 NEologd 字典 !!!
             # 我们从 -r (配置文件) 改为 -d (字典目录)
-            self.tagger = MeCab.Tagger("-r /opt/homebrew/etc/mecabrc -d /opt/homebrew/lib/mecab/dic/mecab-ipadic-neologd")
+            self.tagger = fugashi.GenericTagger("-r /opt/homebrew/etc/mecabrc -d /opt/homebrew/lib/mecab/dic/mecab-ipadic-neologd")
             
         except RuntimeError:
             print("错误: MeCab (NEologd) 未能初始化。")
             print("请确保你已成功安装 mecab-ipadic-neologd")
             print("并且上面的 -d 路径是正确的。")
             sys.exit(1)
+
+        # 重复的行 (标题、对白标记等) 直接命中缓存，跳过 MeCab
+        self.tokenize = functools.lru_cache(maxsize=TOKENIZE_CACHE_SIZE)(self._tokenize)
             
     def read_book_from_local(self, filepath):
         try:
@@ -50,40 +50,72 @@ class AozoraParser:
         parts = RE_SEPARATOR.split(text)
         if len(parts) > 1:
             text = parts[1] 
-        text = RE_ANNOTATION.sub('', text)
         return [line for line in text.splitlines() if line.strip()]
 
+    def _tokenize(self, clean_line):
+        """用 MeCab 分词，返回 ((surface, 平假名读音或 '*'), ...) 元组"""
+        return tuple(
+            (surface, kata_to_hira(reading))
+            for surface, reading in parse_tokens(self.tagger, clean_line)
+        )
+
     def parse_line(self, line):
+        # 大多数行没有注释，只有含 ［＃ 的行才多扫描一遍
+        if '［＃' in line:
+            line = RE_ANNOTATION.sub('', line)
+
+        # ruby 只扫描一遍：同时收集答案并只保留汉字
         answers = {}
-        for match in RE_RUBY.finditer(line):
+        
+        def strip_ruby(match):
             kanji = match.group(1) 
-            reading = kata_to_hira(match.group(2))
-            answers[kanji] = reading
+            answers[kanji] = kata_to_hira(match.group(2))
+            return kanji
             
-        clean_line = RE_RUBY.sub(r'\1', line)
-        node = self.tagger.parseToNode(clean_line)
+        clean_line = RE_RUBY.sub(strip_ruby, line)
+        if not clean_line.strip():
+            return []
         
         sentence_pairs = []
-        while node:
-            surface = node.surface 
-            if not surface: 
-                node = node.next
-                continue
-                
+        for surface, reading in self.tokenize(clean_line):
             if surface in answers:
                 sentence_pairs.append((surface, answers[surface]))
-            else:
-                features = node.feature.split(',')
-                reading = features[7] if len(features) > 7 else '*'
-                
-                if reading != '*':
-                    reading_hiragana = kata_to_hira(reading)
-                    sentence_pairs.append((surface, reading_hiragana))
-            
-            node = node.next
+            elif reading != '*':
+                sentence_pairs.append((surface, reading))
             
         return sentence_pairs
 
+# 每个工作进程各自持有一个 AozoraParser (MeCab 的 tagger 无法 pickle)
+_parser = None
+
+def _init_parser():
+    global _parser
+    _parser = AozoraParser()
+
+def _process_file(filepath):
+    """在工作进程中解析一本书，返回句子列表 (读取失败时返回 None)"""
+    text = _parser.read_book_from_local(filepath)
+    if not text:
+        return None
+        
+    sentences = []
+    for line in _parser.clean_text(text):
+        sentence_pairs = _parser.parse_line(line)
+        if sentence_pairs:
+            sentences.append(sentence_pairs)
+    return sentences
+
+def collect_book_paths():
+    """先遍历数据文件夹，收集最多 MAX_BOOKS_TO_PROCESS 个 .txt 文件路径"""
+    filepaths = []
+    for root, dirs, files in os.walk(DATA_FOLDER):
+        for filename in files:
+            if filename.endswith('.txt'):
+                filepaths.append(os.path.join(root, filename))
+                if len(filepaths) >= MAX_BOOKS_TO_PROCESS:
+                    return filepaths
+    return filepaths
+
 def main():
     print(f"开始使用 Aozora (NEologd) 构建语料库 (最多 {MAX_BOOKS_TO_PROCESS} 本书)...")
     
@@ -91,40 +123,31 @@ def main():
         print(f"错误: 找不到数据文件夹 '{DATA_FOLDER}'")
         sys.exit(1)
         
-    parser = AozoraParser()
-    all_sentences = [] 
+    filepaths = collect_book_paths()
+    sentence_count = 0
     book_count = 0
 
-    for root, dirs, files in os.walk(DATA_FOLDER):
-        if book_count >= MAX_BOOKS_TO_PROCESS:
-            break
-        for filename in files:
-            if book_count >= MAX_BOOKS_TO_PROCESS:
-                break
-            if filename.endswith('.txt'):
-                filepath = os.path.join(root, filename)
-                print(f"--- 正在处理: 书籍 {book_count + 1}/{MAX_BOOKS_TO_PROCESS} ({filename}) ---")
-                
-                text = parser.read_book_from_local(filepath)
-                if not text:
+    # 每本书互不依赖，按书分给多个进程并行解析；结果边到边写，不在内存中累积
+    try:
+        with open(OUTPUT_FILE, 'wb') as out_f, \
+                ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_init_parser) as executor:
+            results = executor.map(_process_file, filepaths, chunksize=4)
+            for i, (filepath, sentences) in enumerate(zip(filepaths, results)):
+                print(f"--- 已处理: 文件 {i + 1}/{len(filepaths)} ({os.path.basename(filepath)}) ---")
+                if sentences is None:
                     continue
                     
-                clean_lines = parser.clean_text(text)
-                
-                for line in clean_lines:
-                    sentence_pairs = parser.parse_line(line)
-                    if sentence_pairs:
-                        all_sentences.append(sentence_pairs)
-                
+                for sentence_pairs in sentences:
+                    out_f.write(orjson.dumps(sentence_pairs) + b'\n')
+                sentence_count += len(sentences)
                 book_count += 1
-                time.sleep(0.01) 
-
-    with open('corpus_raw.json', 'w', encoding='utf-8') as f:
-        json.dump(all_sentences, f, ensure_ascii=False, indent=2)
+    except BrokenProcessPool:
+        print("错误: 工作进程异常退出 (MeCab 是否初始化成功？)")
+        sys.exit(1)
 
     print(f"\n--- 语料库构建完成！ ---")
-    print(f"总共 {len(all_sentences)} 个句子 (来自 {book_count} 本书) 已被保存到 corpus_raw.json")
+    print(f"总共 {sentence_count} 个句子 (来自 {book_count} 本书) 已被保存到 {OUTPUT_FILE}")
     print("你现在可以运行 'python3 train.py' 来训练模型了。")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
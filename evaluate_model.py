@@ -1,107 +1,132 @@
 import argparse
-import json
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Tuple
 
-import MeCab
+import fugashi
+import numpy as np
+import orjson
 
-from yomigami import kata_to_hira, viterbi
+from yomigami import build_tables, confident_path, to_log_space, viterbi_batch
+from yomigami_utils import kata_to_hira, parse_tokens, read_json
 
 DEFAULT_DATASET = "multi_reading_corpus_v1.json"
 DEFAULT_MODEL = "yomigami_model.json"
+BATCH_SIZE = 1024
+PAD = -1
 
 
 def load_json(path: str):
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return read_json(path)
     except FileNotFoundError:
         print(f"Could not find file: {path}")
         sys.exit(1)
-    except json.JSONDecodeError as exc:
+    except orjson.JSONDecodeError as exc:
         print(f"Failed to parse JSON from {path}: {exc}")
         sys.exit(1)
 
 
-def init_tagger() -> MeCab.Tagger:
+def init_tagger() -> fugashi.GenericTagger:
     try:
-        return MeCab.Tagger(
+        return fugashi.GenericTagger(
             "-r /opt/homebrew/etc/mecabrc -d /opt/homebrew/lib/mecab/dic/mecab-ipadic-neologd"
         )
     except RuntimeError:
         # Fall back to default dictionary configuration if neologd is unavailable.
-        return MeCab.Tagger("")
+        return fugashi.GenericTagger("")
 
 
 def parse_sentence(
-    tagger: MeCab.Tagger, sentence: str
+    tagger: fugashi.GenericTagger, sentence: str
 ) -> Tuple[List[str], List[str]]:
     observations: List[str] = []
     mecab_readings: List[str] = []
 
-    node = tagger.parseToNode(sentence)
-    while node:
-        surface = node.surface
-        if surface and surface != "EOS":
-            observations.append(surface)
-            features = node.feature.split(",")
-            reading_kata = features[7] if len(features) > 7 else "*"
-            reading_hira = (
-                kata_to_hira(reading_kata) if reading_kata and reading_kata != "*" else "*"
-            )
-            mecab_readings.append(reading_hira)
-        node = node.next
+    for surface, reading_kata in parse_tokens(tagger, sentence):
+        observations.append(surface)
+        reading_hira = (
+            kata_to_hira(reading_kata) if reading_kata and reading_kata != "*" else "*"
+        )
+        mecab_readings.append(reading_hira)
 
     return observations, mecab_readings
 
 
-def evaluate(model, dataset, limit: int, show_examples: int):
-    tagger = init_tagger()
+# Each tokenizer worker process holds its own tagger (MeCab taggers are not picklable).
+_tagger = None
 
-    token_correct = 0
-    token_total = 0
-    sentence_exact = 0
-    length_mismatches = 0
-    examples = []
 
-    for idx, sample in enumerate(dataset):
-        if limit and idx >= limit:
-            break
+def _init_worker():
+    global _tagger
+    _tagger = init_tagger()
 
-        sentence = sample["sentence"]
-        gold_reading = [kata_to_hira(r) for r in sample["reading"]]
 
-        observations, mecab_readings = parse_sentence(tagger, sentence)
-        predicted_reading, _ = viterbi(model, observations, mecab_readings)
+def _parse_in_worker(sentence: str) -> Tuple[List[str], List[str]]:
+    return parse_sentence(_tagger, sentence)
 
-        # Align lengths; penalize missing tokens by counting them as incorrect.
-        max_len = max(len(gold_reading), len(predicted_reading))
-        token_total += max_len
 
-        if len(gold_reading) != len(predicted_reading):
-            length_mismatches += 1
+def count_matches(gold_batch: List[List[str]], pred_batch: List[List[str]]) -> np.ndarray:
+    """Per-sentence token matches, compared position-wise over padded id matrices."""
+    ids = {}
+    T_max = max(max(len(g), len(p)) for g, p in zip(gold_batch, pred_batch))
+    gold = np.full((len(gold_batch), T_max), PAD, dtype=np.int32)
+    pred = np.full((len(pred_batch), T_max), PAD, dtype=np.int32)
+    for b, (g, p) in enumerate(zip(gold_batch, pred_batch)):
+        gold[b, : len(g)] = [ids.setdefault(r, len(ids)) for r in g]
+        pred[b, : len(p)] = [ids.setdefault(r, len(ids)) for r in p]
 
-        correct_tokens = sum(
-            1
-            for g, p in zip(gold_reading, predicted_reading)
-            if g == p
-        )
-        token_correct += correct_tokens
+    mask = (gold != PAD) & (pred != PAD)
+    return ((gold == pred) & mask).sum(axis=1)
 
-        all_match = (
-            len(gold_reading) == len(predicted_reading)
-            and correct_tokens == len(gold_reading)
-        )
-        if all_match:
-            sentence_exact += 1
-        elif len(examples) < show_examples:
-            examples.append(
-                {
-                    "sentence": sentence,
-                    "gold": gold_reading,
-                    "pred": predicted_reading,
-                }
-            )
+
+def evaluate(model, dataset, limit: int, show_examples: int, fast: bool = False):
+    samples = dataset[:limit] if limit else dataset
+
+    token_correct = 0
+    token_total = 0
+    sentence_exact = 0
+    length_mismatches = 0
+    examples = []
+
+    with ProcessPoolExecutor(initializer=_init_worker) as executor:
+        for start in range(0, len(samples), BATCH_SIZE):
+            batch = samples[start : start + BATCH_SIZE]
+            sentences = [sample["sentence"] for sample in batch]
+            gold_readings = [[kata_to_hira(r) for r in sample["reading"]] for sample in batch]
+
+            parsed = list(executor.map(_parse_in_worker, sentences, chunksize=64))
+
+            # With --fast, unambiguous sentences keep MeCab's readings and skip Viterbi;
+            # the rest are decoded together.
+            if fast:
+                results = [confident_path(model, obs, hints) for obs, hints in parsed]
+            else:
+                results = [None] * len(parsed)
+            pending = [i for i, result in enumerate(results) if result is None]
+            for i, result in zip(pending, viterbi_batch(model, [parsed[i] for i in pending])):
+                results[i] = result
+            predicted_readings = [path for path, _ in results]
+
+            correct = count_matches(gold_readings, predicted_readings)
+            gold_len = np.array([len(g) for g in gold_readings])
+            pred_len = np.array([len(p) for p in predicted_readings])
+
+            # Align lengths; penalize missing tokens by counting them as incorrect.
+            token_total += int(np.maximum(gold_len, pred_len).sum())
+            token_correct += int(correct.sum())
+            length_mismatches += int((gold_len != pred_len).sum())
+
+            all_match = (gold_len == pred_len) & (correct == gold_len)
+            sentence_exact += int(all_match.sum())
+            for i in np.flatnonzero(~all_match)[: show_examples - len(examples)]:
+                examples.append(
+                    {
+                        "sentence": sentences[i],
+                        "gold": gold_readings[i],
+                        "pred": predicted_readings[i],
+                    }
+                )
 
     token_accuracy = (token_correct / token_total * 100) if token_total else 0.0
     sentence_accuracy = (
@@ -151,12 +176,17 @@ def main():
         default=5,
         help="Number of mismatch examples to show (default: 5)",
     )
+    parser.add_argument(
+        "--fast",
+        action="store_true",
+        help="Skip Viterbi for sentences MeCab reads confidently (faster, but not a pure model metric)",
+    )
     args = parser.parse_args()
 
-    model = load_json(args.model)
+    model = build_tables(to_log_space(load_json(args.model)))
     dataset = load_json(args.dataset)
 
-    evaluate(model, dataset, args.limit, args.examples)
+    evaluate(model, dataset, args.limit, args.examples, args.fast)
 
 
 if __name__ == "__main__":
@@ -1,50 +1,50 @@
-import json
+import functools
 import sys
 
 # 确保 MeCab Python 绑定已安装
 try:
-    import MeCab
+    import fugashi
 except ImportError:
-    print("错误: 未安装 MeCab Python 绑定 (mecab-python3)。\n请安装 mecab-python3。")
+    print("错误: 未安装 MeCab Python 绑定 (fugashi)。\n请安装 fugashi。")
     sys.exit(1)
 
+from yomigami_utils import kata_to_hira_nospace, parse_tokens, read_json, write_json
+
 # --- 配置 ---
 CUSTOM_FILE = 'multi_reading_corpus_v1.json'
 OUTPUT_FILE = 'corpus_custom.json'
 # 确保你的 MeCab 路径是正确的
 MECAB_CONFIG = "-r /opt/homebrew/etc/mecabrc -d /opt/homebrew/lib/mecab/dic/mecab-ipadic-neologd"
-
-# --- 修正后的 kata_to_hira 函数 (在 preprocess_custom.py 文件中) ---
-
-def kata_to_hira(katakana_string):
-    """将片假名转换为平假名（并移除所有空格，确保对齐）"""
-    hiragana = []
-    for char in katakana_string:
-        code = ord(char)
-        if 12449 <= code <= 12534: 
-            # 这是一个片假名，转换为平假名
-            hiragana.append(chr(code - 96)) 
-        else:
-            # 非片假名（如空格、标点）保持不变
-            hiragana.append(char)
-    # 关键修正：确保在返回前移除所有空格，防止在 zip() 对齐时出错
-    return "".join(hiragana).replace(' ', '')
+TOKENIZE_CACHE_SIZE = 200_000  # MeCab 分词结果的 LRU 缓存条数
 
 def main():
     print(f"开始预处理自定义语料库 '{CUSTOM_FILE}'...")
     
     try:
-        tagger = MeCab.Tagger(MECAB_CONFIG)
+        tagger = fugashi.GenericTagger(MECAB_CONFIG)
     except RuntimeError:
         print("错误: MeCab 初始化失败。请检查 MECAB_CONFIG 路径是否正确。")
         sys.exit(1)
     
+    # 重复的句子直接命中缓存，跳过 MeCab
+    @functools.lru_cache(maxsize=TOKENIZE_CACHE_SIZE)
+    def tokenize(sentence):
+        """返回句子中“有读音的词语”的 surface 元组"""
+        surface_words = [] 
+        
+        # 获取 MeCab 的读音 (作为判断是否为“词语”的标准)
+        for surface, reading_kata in parse_tokens(tagger, sentence, missing=''):
+            # 如果 MeCab 给出了读音（通常表明它是一个有意义的词），我们才记录它
+            if reading_kata != '*':
+                surface_words.append(surface)
+            
+        return tuple(surface_words)
+    
     final_corpus = []
 
     # 1. 加载文件
     try:
-        with open(CUSTOM_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        data = read_json(CUSTOM_FILE)
     except FileNotFoundError:
         print(f"错误: 找不到自定义语料库文件 '{CUSTOM_FILE}'")
         sys.exit(1)
@@ -56,25 +56,9 @@ def main():
     for item in data:
         sentence = item['sentence']
         # 目标读音转换为平假名，并移除空格
-        target_readings = [kata_to_hira(r) for r in item['reading']] 
-        
-        node = tagger.parseToNode(sentence)
-        
-        surface_words = [] 
+        target_readings = [kata_to_hira_nospace(r) for r in item['reading']] 
         
-        while node:
-            surface = node.surface
-            # 过滤掉空的 surface (如 EOS)
-            if surface and surface != 'EOS':
-                features = node.feature.split(',')
-                # 获取 MeCab 的读音 (作为判断是否为“词语”的标准)
-                reading_kata = features[7] if len(features) > 7 else '' 
-                
-                # 如果 MeCab 给出了读音（通常表明它是一个有意义的词），我们才记录它
-                if reading_kata != '*':
-                    surface_words.append(surface)
-                    
-            node = node.next
+        surface_words = tokenize(sentence)
 
         # 核心检查：只检查“有读音的词语”数量
         if len(surface_words) != len(target_readings):
@@ -89,8 +73,7 @@ def main():
 
     # 3. 保存文件
     try:
-        with open(OUTPUT_FILE, 'w', encoding='utf-8') as out_f:
-            json.dump(final_corpus, out_f, ensure_ascii=False, indent=2)
+        write_json(final_corpus, OUTPUT_FILE)
         print(f"\n--- 预处理完成！---")
         print(f"成功处理 {successful_count} / {total_count} 条句子，已保存到 '{OUTPUT_FILE}'。")
     except Exception as e:
@@ -1,126 +1,159 @@
-import json
-from collections import defaultdict, Counter
+import sys
+import numpy as np
+import orjson
 
-CORPUS_FILE = 'corpus_raw.json'
+from yomigami_utils import write_json
+
+CORPUS_FILE = 'corpus_raw.jsonl'
 MODEL_FILE = 'yomigami_model.json'
-Aozora_FILE = 'corpus_raw.json'
+Aozora_FILE = 'corpus_raw.jsonl'
 CUSTOM_PROCESSED_FILE = 'corpus_custom.json' # <-- 添加这个新常量
 
 # 拉普拉斯平滑 (加一平滑)
 LAPLACE_SMOOTHING = 1.0
 
-def normalize(counts):
+def count_pairs(rows, cols):
     """
-    将一个计数器 (e.g., {'A': 1, 'B': 3}) 转换为概率字典。
-    返回一个字典 (e.g., {'A': 0.25, 'B': 0.75})。
+    统计 (row, col) 整数对的出现次数。
+    把每一对打包成一个 uint64 键 (row << 32 | col)，再用一次 np.unique 计数。
+    返回 (rows, cols, counts) 三个数组，按键排序。
     """
-    total = sum(counts.values())
-    
-    # 如果总数为 0 (例如一个从未见过的词)，我们无法归一化。
-    if total == 0:
-        return {}
-        
-    probabilities = {}
-    for key, count in counts.items():
-        probabilities[key] = count / total
-    return probabilities
+    keys = (np.asarray(rows, dtype=np.uint64) << np.uint64(32)) | np.asarray(cols, dtype=np.uint64)
+    keys, counts = np.unique(keys, return_counts=True)
+    return (keys >> np.uint64(32)).astype(np.int64), (keys & np.uint64(0xFFFFFFFF)).astype(np.int64), counts
 
-def normalize_with_smoothing(counts, vocabulary_size):
+def normalize(rows, counts, num_rows):
+    """
+    按行把计数转换为概率: count / 该行总数。
+    (每一行至少有一个计数，所以不会除以 0。)
     """
-    使用拉普拉斯平滑来归一化计数器。
+    totals = np.bincount(rows, weights=counts, minlength=num_rows)
+    return counts / totals[rows]
+
+def normalize_with_smoothing(rows, counts, num_rows, vocabulary_size):
+    """
+    使用拉普拉斯平滑按行归一化计数。
     vocabulary_size (V) 是所有可能结果的数量。
+    返回 (每个计数的概率, 每一行的 "__DEFAULT__" 概率)。
     """
-    total = sum(counts.values())
-    
     # (count + k) / (N + k*V)
     # 这里我们使用 k=1 (加一平滑)
-    denominator = total + (LAPLACE_SMOOTHING * vocabulary_size)
+    denominators = np.bincount(rows, weights=counts, minlength=num_rows) + (LAPLACE_SMOOTHING * vocabulary_size)
     
-    probabilities = {}
-    for key, count in counts.items():
-        probabilities[key] = (count + LAPLACE_SMOOTHING) / denominator
-        
     # 我们还需要一个 "__DEFAULT__" 概率，用于处理从未见过的转换
     # P(unseen) = k / (N + k*V)
-    probabilities['__DEFAULT__'] = LAPLACE_SMOOTHING / denominator
+    return (counts + LAPLACE_SMOOTHING) / denominators[rows], LAPLACE_SMOOTHING / denominators
+
+def to_nested(rows, cols, probabilities, row_names, col_names):
+    """
+    把 (row, col, 概率) 数组还原成 {row_name: {col_name: 概率}} 字典。
+    rows 已按键排好序 (见 count_pairs)，每一行是一段连续区间，整段一次建成内层字典。
+    """
+    if len(rows) == 0:
+        return {}
+        
+    starts = (np.flatnonzero(np.diff(rows)) + 1).tolist()
+    rows = rows.tolist()
+    cols = cols.tolist()
+    probabilities = probabilities.tolist()
     
-    return probabilities
+    nested = {}
+    for lo, hi in zip([0] + starts, starts + [len(rows)]):
+        nested[row_names[rows[lo]]] = {col_names[c]: p for c, p in zip(cols[lo:hi], probabilities[lo:hi])}
+    return nested
+
+def read_corpus(path):
+    """逐行读取 JSONL 语料库 (每行一个句子)，不必把整个文件载入内存"""
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield orjson.loads(line)
 
 def main():
-    print(f"正在从 {CORPUS_FILE} 加载语料库...")
+    print(f"正在从 {CORPUS_FILE} 逐行读取语料库...")
+    print("开始训练 HMM 模型...")
+
+    # 把汉字和读音编码为整数 ID
+    kanji_id = {}
+    reading_id = {}
+    
+    # 1. 发射 (Emission): 每个 (汉字, 读音) 对
+    emission_kanji = []
+    emission_reading = []
+    
+    # 2. 转移 (Transition): 每个 (读音_i-1, 读音_i) 对
+    transition_prev = []
+    transition_next = []
+    
+    # 3. 先验 (Prior): 句子第一个词的读音
+    prior_reading = []
+    
+    num_sentences = 0
+
+    # --- 第一轮：收集 ID ---
     try:
-        with open(CORPUS_FILE, 'r', encoding='utf-8') as f:
-            corpus = json.load(f)
+        for sentence in read_corpus(CORPUS_FILE):
+            num_sentences += 1
+            if not sentence:
+                continue
+                
+            prev_id = None
+            
+            for (kanji, reading) in sentence:
+                k = kanji_id.setdefault(kanji, len(kanji_id))
+                r = reading_id.setdefault(reading, len(reading_id))
+                emission_kanji.append(k)
+                emission_reading.append(r)
+                
+                if prev_id is None:
+                    prior_reading.append(r)
+                else:
+                    transition_prev.append(prev_id)
+                    transition_next.append(r)
+                    
+                prev_id = r
     except FileNotFoundError:
         print(f"错误: 找不到语料库文件 '{CORPUS_FILE}'")
         print("请先运行 'python3 build_local_corpus.py' 来生成数据。")
         sys.exit(1)
-    except json.JSONDecodeError:
-        print(f"错误: {CORPUS_FILE} 文件已损坏或为空。")
+    except orjson.JSONDecodeError:
+        print(f"错误: {CORPUS_FILE} 文件已损坏。")
         print("请尝试重新运行 'python3 build_local_corpus.py'。")
         sys.exit(1)
         
-    print(f"语料库加载成功！共 {len(corpus)} 个句子。")
-    print("开始训练 HMM 模型...")
-
-    # 初始化计数器
-    # 1. 发射计数 (Emission): P(汉字 | 读音)
-    #    e.g., emission_counts['とうし']['投資'] = 100
-    emission_counts = defaultdict(Counter)
-    
-    # 2. 转移计数 (Transition): P(读音_i | 读音_i-1)
-    #    e.g., transition_counts['わたし']['は'] = 500
-    transition_counts = defaultdict(Counter)
-    
-    # 3. 先验计数 (Prior): P(读音) (作为句子的第一个词)
-    #    e.g., prior_counts['わたし'] = 200
-    prior_counts = Counter()
-    
+    print(f"语料库读取完成！共 {num_sentences} 个句子。")
+            
     # 4. 读音词汇表 (用于平滑)
-    reading_vocabulary = set()
+    kanji_names = list(kanji_id)
+    reading_names = list(reading_id)
+    vocabulary_size = len(reading_names)
 
-    # --- 第一轮：计数 ---
-    for sentence in corpus:
-        if not sentence:
-            continue
-            
-        # 1. 计数先验概率 (Prior)
-        first_word_reading = sentence[0][1] # (汉字, 读音)
-        prior_counts[first_word_reading] += 1
-        
-        prev_reading = None
-        
-        for (kanji, reading) in sentence:
-            # 2. 计数发射概率 (Emission)
-            emission_counts[kanji][reading] += 1
-            
-            # 3. 计数转移概率 (Transition)
-            if prev_reading is not None:
-                transition_counts[prev_reading][reading] += 1
-                
-            # 4. 更新词汇表和 prev_reading
-            reading_vocabulary.add(reading)
-            prev_reading = reading
+    # 一次性计数所有 (row, col) 对
+    e_rows, e_cols, e_counts = count_pairs(emission_kanji, emission_reading)
+    t_rows, t_cols, t_counts = count_pairs(transition_prev, transition_next)
+    p_cols, p_counts = np.unique(np.asarray(prior_reading, dtype=np.int64), return_counts=True)
+    p_rows = np.zeros_like(p_cols)
             
     print("计数完成。")
-    vocabulary_size = len(reading_vocabulary)
     print(f"读音词汇表大小 (V) = {vocabulary_size}")
 
     # --- 第二轮：规范化 (计算概率) ---
     print("正在计算概率 (规范化)...")
     
     # 1. 规范化先验概率
-    priors = normalize_with_smoothing(prior_counts, vocabulary_size)
+    p_probs, p_default = normalize_with_smoothing(p_rows, p_counts, 1, vocabulary_size)
+    priors = {reading_names[c]: p for c, p in zip(p_cols.tolist(), p_probs.tolist())}
+    priors['__DEFAULT__'] = float(p_default[0])
     
     # 2. 规范化转移概率
-    transitions = {}
-    for prev_reading, next_reading_counts in transition_counts.items():
-        transitions[prev_reading] = normalize_with_smoothing(next_reading_counts, vocabulary_size)
+    t_probs, t_default = normalize_with_smoothing(t_rows, t_counts, vocabulary_size, vocabulary_size)
+    transitions = to_nested(t_rows, t_cols, t_probs, reading_names, reading_names)
+    for r in np.unique(t_rows).tolist():
+        transitions[reading_names[r]]['__DEFAULT__'] = float(t_default[r])
         
     # 3. 规范化发射概率 (这里不需要平滑，因为 P(汉字|读音) 是固定的)
-    emissions = {}
-    for kanji, reading_counts in emission_counts.items():
-        emissions[kanji] = normalize(reading_counts)
+    e_probs = normalize(e_rows, e_counts, len(kanji_names))
+    emissions = to_nested(e_rows, e_cols, e_probs, kanji_names, reading_names)
         
     print("概率计算完成。")
 
@@ -133,9 +166,8 @@ def main():
 
     # --- 保存模型 ---
     try:
-        with open(MODEL_FILE, 'w', encoding='utf-8') as f:
-            # 确保保存的是 'model' 字典，而不是 'priors' 或其他
-            json.dump(model, f, ensure_ascii=False, indent=2)
+        # 确保保存的是 'model' 字典，而不是 'priors' 或其他
+        write_json(model, MODEL_FILE)
     except Exception as e:
         print(f"保存模型到 {MODEL_FILE} 时出错: {e}")
         sys.exit(1)
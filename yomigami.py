@@ -1,131 +1,333 @@
-import json
-import MeCab
+import fugashi
 import math
 import sys
+import numpy as np
+from numba import njit
+
+from yomigami_utils import kata_to_hira, parse_tokens, read_json
 
 MODEL_FILE = 'yomigami_model.json'
 
-def kata_to_hira(katakana_string):
-    """Convert a katakana string to hiragana."""
-    hiragana = []
-    for char in katakana_string:
-        code = ord(char)
-        if 12449 <= code <= 12534: 
-            hiragana.append(chr(code - 96)) 
-        else:
-            hiragana.append(char)
-    return "".join(hiragana)
+DEFAULT_PROB = 1e-10  # fallback for unseen transitions and emissions
+LOG_DEFAULT_PROB = math.log(DEFAULT_PROB)
+CONFIDENT_EMISSION = 0.9  # skip Viterbi when every MeCab hint is at least this likely
+LOG_CONFIDENT_EMISSION = math.log(CONFIDENT_EMISSION)
 
-def viterbi(model, observations, mecab_readings): 
+def to_log_space(model):
     """
-    Run the Viterbi algorithm.
-    Returns (best_path, cumulative log-prob sequence).
+    Replace every probability in the model with its log, in place.
+    Zero probabilities are floored to LOG_DEFAULT_PROB, same as unseen entries.
     """
-    
-    T = len(observations)
-    if T == 0:
-        return ([], [])  # empty path and prob sequence
+    def log_row(row):
+        for key, p in row.items():
+            row[key] = math.log(p) if p > 0 else LOG_DEFAULT_PROB
+
+    log_row(model['priors'])
+    for row in model['transitions'].values():
+        log_row(row)
+    for row in model['emissions'].values():
+        log_row(row)
+    return model
 
-    # unpack parameters from the model
+def build_tables(model):
+    """
+    Compile a log-space model (see to_log_space) into array tables for viterbi(): a log prior vector plus CSR transitions and emissions.
+    The extra last state index stands for readings the model has never seen.
+    """
     start_p = model['priors']
     trans_p = model['transitions']
     emit_p = model['emissions']
 
-    V = [{}]  # V[t][y] holds max log prob at time t for state y
-    path = {}
-    
-    # cumulative log-prob sequence for the best path
-    final_delta_sequence = [] 
-    
-    start_obs = observations[0]
-    start_hint = mecab_readings[0] 
-    
-    possible_states_t0 = emit_p.get(start_obs, {}).keys()
-    
-    if not possible_states_t0:
-        if start_hint != '*':
-            possible_states_t0 = [start_hint] 
+    # collect every reading the model knows about
+    states = set(start_p)
+    for row in trans_p.values():
+        states.update(row)
+    states.update(trans_p)
+    for row in emit_p.values():
+        states.update(row)
+    states.discard('__DEFAULT__')
+    states = sorted(states)
+    state_to_idx = {y: i for i, y in enumerate(states)}
+    S = len(states)
+
+    log_prior = np.full(S + 1, start_p.get('__DEFAULT__', LOG_DEFAULT_PROB), dtype=np.float32)
+    for y, p in start_p.items():
+        if y in state_to_idx:
+            log_prior[state_to_idx[y]] = p
+
+    # sparse transitions in CSR form: row i (prev state) spans trans_indptr[i]:trans_indptr[i + 1],
+    # sorted by column so _log_trans can binary-search it; missing pairs fall back to LOG_DEFAULT_PROB.
+    # A dense (S, S) matrix would not fit in memory for a full Aozora vocabulary.
+    trans_rows = [[] for _ in range(S + 1)]  # row S (unknown state) stays empty
+    for y_prev, row in trans_p.items():
+        i = state_to_idx[y_prev]
+        trans_rows[i] = sorted((state_to_idx[y], p) for y, p in row.items() if y in state_to_idx)
+    trans_indptr = [0]
+    trans_indices = []
+    trans_data = []
+    for row in trans_rows:
+        for j, p in row:
+            trans_indices.append(j)
+            trans_data.append(p)
+        trans_indptr.append(len(trans_indices))
+
+    # sparse emissions in CSR form: row r (kanji) spans emit_indptr[r]:emit_indptr[r + 1]
+    # candidates are ordered by descending reading so argmax breaks ties like max() on (prob, state)
+    kanji_to_row = {}
+    emit_indptr = [0]
+    emit_indices = []
+    emit_data = []
+    for kanji, row in emit_p.items():
+        kanji_to_row[kanji] = len(kanji_to_row)
+        for y in sorted(row, reverse=True):
+            emit_indices.append(state_to_idx[y])
+            emit_data.append(row[y])
+        emit_indptr.append(len(emit_indices))
+
+    return {
+        'states': states,
+        'idx_to_state': states + [None],  # slot for the unknown state, filled from fallbacks
+        'state_to_idx': state_to_idx,
+        'log_prior': log_prior,
+        'trans_indptr': np.array(trans_indptr, dtype=np.int64),
+        'trans_indices': np.array(trans_indices, dtype=np.int32),
+        'trans_data': np.array(trans_data, dtype=np.float32),
+        'kanji_to_row': kanji_to_row,
+        'emit_indptr': np.array(emit_indptr, dtype=np.int32),
+        'emit_indices': np.array(emit_indices, dtype=np.int32),
+        'emit_data': np.array(emit_data, dtype=np.float32),
+        # log-space dicts, for confident_path()
+        'log_priors': start_p,
+        'log_transitions': trans_p,
+        'log_emissions': emit_p,
+    }
+
+@njit(cache=True)
+def _log_trans(prev, y, trans_indptr, trans_indices, trans_data, log_default):
+    """log P(y | prev) from the CSR transition table, or log_default for unseen pairs."""
+    lo = trans_indptr[prev]
+    end = trans_indptr[prev + 1]
+    hi = end
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if trans_indices[mid] < y:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo < end and trans_indices[lo] == y:
+        return trans_data[lo]
+    return log_default
+
+@njit(cache=True, fastmath=True)
+def _viterbi_core(obs_idx, hint_idx, log_prior, trans_indptr, trans_indices, trans_data, emit_indptr, emit_indices, emit_data, log_default):
+    """
+    Viterbi recursion over index arrays.
+    obs_idx[t] is the emission row of token t, or -1 to use the single state hint_idx[t].
+    log_default is used for unseen transitions and for the emission of hint states.
+    Returns (state index per token, cumulative log prob per token).
+    """
+    T = obs_idx.shape[0]
+
+    # candidate count per time step
+    counts = np.ones(T, dtype=np.int32)
+    for t in range(T):
+        if obs_idx[t] >= 0:
+            counts[t] = emit_indptr[obs_idx[t] + 1] - emit_indptr[obs_idx[t]]
+    K = counts.max()
+
+    # cand[t, k] is the state of candidate k at time t, emit[t, k] its emission log prob
+    cand = np.empty((T, K), dtype=np.int32)
+    emit = np.empty((T, K), dtype=np.float32)
+    for t in range(T):
+        if obs_idx[t] >= 0:
+            lo = emit_indptr[obs_idx[t]]
+            for k in range(counts[t]):
+                cand[t, k] = emit_indices[lo + k]
+                emit[t, k] = emit_data[lo + k]
         else:
-            # fallback to the surface form if we have no hint and no emission entry
-            possible_states_t0 = [start_obs]
+            cand[t, 0] = hint_idx[t]
+            emit[t, 0] = log_default
+
+    delta = np.empty((T, K), dtype=np.float64)  # delta[t, k] holds max log prob at time t for candidate k
+    backptr = np.zeros((T, K), dtype=np.int32)
 
     # 1. Initialization (t=0)
-    for y in possible_states_t0:
-        emission_prob = emit_p.get(start_obs, {}).get(y, 1e-10) 
-        prior_prob = start_p.get(y, start_p.get('__DEFAULT__', 1e-10))
-        
-        V[0][y] = math.log(prior_prob) + math.log(emission_prob)
-        path[y] = [y]
+    for k in range(counts[0]):
+        delta[0, k] = log_prior[cand[0, k]] + emit[0, k]
 
     # 2. Recursion
     for t in range(1, T):
-        V.append({})
-        new_path = {}
-        
-        obs = observations[t]
-        hint = mecab_readings[t] 
-        
-        possible_states_t = emit_p.get(obs, {}).keys()
-        
-        if not possible_states_t:
-            if hint != '*':
-                possible_states_t = [hint]
-            else:
-                possible_states_t = [obs]
-        
-        for y in possible_states_t:
-            emission_prob = emit_p.get(obs, {}).get(y, 1e-10) 
-            
-            # find the best previous state transition
-            # (prob, state) = max( V[t-1][y_prev] + log(P(y | y_prev)) )
-            (max_prob, best_prev_state) = max(
-                (V[t-1][y_prev] + math.log(trans_p.get(y_prev, {}).get(y, trans_p.get('__DEFAULT__', 1e-10))) + math.log(emission_prob), y_prev)
-                for y_prev in V[t-1] 
-            )
-            
-            V[t][y] = max_prob
-            # store backpointer only; path rebuilt at the end
-            new_path[y] = best_prev_state 
-            
-        # path stores backpointers, not the full path
-        path[t] = new_path
-        
+        for k in range(counts[t]):
+            y = cand[t, k]
+            best = delta[t - 1, 0] + _log_trans(cand[t - 1, 0], y, trans_indptr, trans_indices, trans_data, log_default)
+            best_j = 0
+            for j in range(1, counts[t - 1]):
+                score = delta[t - 1, j] + _log_trans(cand[t - 1, j], y, trans_indptr, trans_indices, trans_data, log_default)
+                if score > best:
+                    best = score
+                    best_j = j
+            delta[t, k] = best + emit[t, k]
+            backptr[t, k] = best_j
+
     # 3. Termination and backtrace
-    if not V[T-1]:
-        print("  > Warning: unable to decode sentence.")
-        return (["?"] * T, [-math.inf] * T)
-
-    # find (best final prob, best last state)
-    (max_prob, best_last_state) = max((V[T-1][y], y) for y in V[T-1])
-    
-    # reconstruct best path and log prob sequence
-    best_path_sequence = [best_last_state]
-    log_probs_sequence = [max_prob]
-    
-    # backtrace
-    current_state = best_last_state
-    for t in range(T - 2, -1, -1):
-        current_state = path[t+1][current_state]
-        best_path_sequence.insert(0, current_state)
-        # record cumulative log prob
-        log_probs_sequence.insert(0, V[t][current_state]) 
+    k = 0
+    for j in range(1, counts[T - 1]):
+        if delta[T - 1, j] > delta[T - 1, k]:
+            k = j
+
+    path_idx = np.empty(T, dtype=np.int32)
+    logp = np.empty(T, dtype=np.float64)
+    for t in range(T - 1, -1, -1):
+        path_idx[t] = cand[t, k]
+        logp[t] = delta[t, k]
+        k = backptr[t, k]
+
+    return path_idx, logp
 
+@njit(cache=True, fastmath=True)
+def _viterbi_batch_core(offsets, obs_idx, hint_idx, log_prior, trans_indptr, trans_indices, trans_data, emit_indptr, emit_indices, emit_data, log_default):
+    """
+    Run _viterbi_core on every sentence of a batch in one call.
+    Sentence i spans obs_idx[offsets[i]:offsets[i + 1]]; results use the same flat layout.
+    """
+    path_idx = np.empty(obs_idx.shape[0], dtype=np.int32)
+    logp = np.empty(obs_idx.shape[0], dtype=np.float64)
+    for i in range(offsets.shape[0] - 1):
+        lo = offsets[i]
+        hi = offsets[i + 1]
+        if hi > lo:
+            path_idx[lo:hi], logp[lo:hi] = _viterbi_core(
+                obs_idx[lo:hi], hint_idx[lo:hi], log_prior,
+                trans_indptr, trans_indices, trans_data,
+                emit_indptr, emit_indices, emit_data, log_default,
+            )
+    return path_idx, logp
+
+def _encode(tables, observations, mecab_readings):
+    """
+    Map a tokenized sentence to the index arrays _viterbi_core expects.
+    Returns (obs_idx, hint_idx, fallbacks), fallbacks being {t: reading} for tokens without an emission row.
+    """
+    T = len(observations)
+    state_to_idx = tables['state_to_idx']
+    kanji_to_row = tables['kanji_to_row']
+    unknown_idx = len(tables['states'])
+
+    obs_idx = np.full(T, -1, dtype=np.int32)
+    hint_idx = np.full(T, unknown_idx, dtype=np.int32)
+    fallbacks = {}
+    for t, (obs, hint) in enumerate(zip(observations, mecab_readings)):
+        row = kanji_to_row.get(obs)
+        if row is not None:
+            obs_idx[t] = row
+        else:
+            # fall back to the MeCab hint, or the surface form if we have no hint
+            name = hint if hint != '*' else obs
+            fallbacks[t] = name
+            hint_idx[t] = state_to_idx.get(name, unknown_idx)
+
+    return obs_idx, hint_idx, fallbacks
+
+def _decode(tables, path_idx, fallbacks):
+    """Map state indices from _viterbi_core back to readings."""
+    idx_to_state = tables['idx_to_state']
+    path = [idx_to_state[i] for i in path_idx.tolist()]
+    for t, name in fallbacks.items():
+        path[t] = name
+    return path
+
+def confident_path(tables, observations, mecab_readings):
+    """
+    Shortcut for unambiguous sentences: if every MeCab hint has emission prob above CONFIDENT_EMISSION,
+    return (hints, cumulative log-prob sequence) without running Viterbi. Otherwise return None.
+    The log probs score the hint path with the same prior, transition and emission terms Viterbi uses,
+    so they are comparable with viterbi() output (the hint path is not guaranteed to be the best path).
+    """
+    log_priors = tables['log_priors']
+    log_transitions = tables['log_transitions']
+    log_emissions = tables['log_emissions']
+    log_prob = 0.0
+    log_probs_sequence = []
+    prev_hint = None
+    for obs, hint in zip(observations, mecab_readings):
+        row = log_emissions.get(obs)
+        log_emission = row.get(hint) if row is not None else None
+        if log_emission is None or log_emission <= LOG_CONFIDENT_EMISSION:
+            return None
+        if prev_hint is None:
+            log_prob += log_priors.get(hint, log_priors.get('__DEFAULT__', LOG_DEFAULT_PROB))
+        else:
+            log_prob += log_transitions.get(prev_hint, {}).get(hint, LOG_DEFAULT_PROB)
+        log_prob += log_emission
+        log_probs_sequence.append(log_prob)
+        prev_hint = hint
+
+    return (list(mecab_readings), log_probs_sequence)
+
+def viterbi(tables, observations, mecab_readings):
+    """
+    Run the Viterbi algorithm over the tables from build_tables().
+    Returns (best_path, cumulative log-prob sequence).
+    """
+
+    T = len(observations)
+    if T == 0:
+        return ([], [])  # empty path and prob sequence
+
+    obs_idx, hint_idx, fallbacks = _encode(tables, observations, mecab_readings)
+    path_idx, logp = _viterbi_core(
+        obs_idx, hint_idx,
+        tables['log_prior'],
+        tables['trans_indptr'], tables['trans_indices'], tables['trans_data'],
+        tables['emit_indptr'], tables['emit_indices'], tables['emit_data'],
+        LOG_DEFAULT_PROB,
+    )
 
     # return (best path, cumulative log prob sequence)
-    return (best_path_sequence, log_probs_sequence)
+    return (_decode(tables, path_idx, fallbacks), logp.tolist())
+
+def viterbi_batch(tables, batch):
+    """
+    Run viterbi() over a list of (observations, mecab_readings) pairs with a single JIT call.
+    Returns a list of (best_path, cumulative log-prob sequence), one per sentence.
+    """
+    if not batch:
+        return []
+
+    encoded = [_encode(tables, observations, mecab_readings) for observations, mecab_readings in batch]
+    offsets = np.zeros(len(batch) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(obs_idx) for obs_idx, _, _ in encoded])
+
+    path_idx, logp = _viterbi_batch_core(
+        offsets,
+        np.concatenate([obs_idx for obs_idx, _, _ in encoded]),
+        np.concatenate([hint_idx for _, hint_idx, _ in encoded]),
+        tables['log_prior'],
+        tables['trans_indptr'], tables['trans_indices'], tables['trans_data'],
+        tables['emit_indptr'], tables['emit_indices'], tables['emit_data'],
+        LOG_DEFAULT_PROB,
+    )
+
+    results = []
+    for i, (_, _, fallbacks) in enumerate(encoded):
+        lo, hi = offsets[i], offsets[i + 1]
+        results.append((_decode(tables, path_idx[lo:hi], fallbacks), logp[lo:hi].tolist()))
+    return results
 
 
 def main():
     print("Loading model...")
     try:
-        with open(MODEL_FILE, 'r', encoding='utf-8') as f:
-            model = json.load(f)
+        model = build_tables(to_log_space(read_json(MODEL_FILE)))
     except FileNotFoundError:
         print(f"Error: model file not found '{MODEL_FILE}'")
         sys.exit(1)
+
+    # compile the JIT core now so the first query is not slow
+    viterbi(model, ['。'], ['。'])
         
     try:
-        tagger = MeCab.Tagger("-r /opt/homebrew/etc/mecabrc -d /opt/homebrew/lib/mecab/dic/mecab-ipadic-neologd")
+        tagger = fugashi.GenericTagger("-r /opt/homebrew/etc/mecabrc -d /opt/homebrew/lib/mecab/dic/mecab-ipadic-neologd")
     except RuntimeError as e:
         print(f"MeCab initialization failed: {e}")
         sys.exit(1)
@@ -141,26 +343,21 @@ def main():
                 print("Goodbye!")
                 break
             
-            node = tagger.parseToNode(sentence)
-            
             observations = []  # kanji sequence
             original_words = []  # original words (same as observations, kept for clarity)
             mecab_readings = []  # MeCab reading hints
             
-            while node:
-                surface = node.surface
-                if surface and surface != 'EOS': 
-                    observations.append(surface)
-                    original_words.append(surface)
-                    
-                    features = node.feature.split(',')
-                    reading_kata = features[7] if len(features) > 7 else '*'
-                    reading_hira = kata_to_hira(reading_kata)
-                    mecab_readings.append(reading_hira)
-                    
-                node = node.next
+            for surface, reading_kata in parse_tokens(tagger, sentence):
+                observations.append(surface)
+                original_words.append(surface)
+                
+                reading_hira = kata_to_hira(reading_kata)
+                mecab_readings.append(reading_hira)
             
-            best_path, log_probs_sequence = viterbi(model, observations, mecab_readings)
+            result = confident_path(model, observations, mecab_readings)
+            if result is None:
+                result = viterbi(model, observations, mecab_readings)
+            best_path, log_probs_sequence = result
             
             # 3. Render output with cumulative log probs
             output_parts = []
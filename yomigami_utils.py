@@ -0,0 +1,43 @@
+"""Helpers shared by the YomiGami scripts."""
+
+import orjson
+
+# katakana (U+30A1..U+30F6) -> hiragana, built once at import
+_KATA_HIRA_TABLE = str.maketrans({chr(c): chr(c - 96) for c in range(12449, 12535)})
+
+def kata_to_hira(katakana_string):
+    """Convert a katakana string to hiragana."""
+    return katakana_string.translate(_KATA_HIRA_TABLE)
+
+def kata_to_hira_nospace(katakana_string):
+    """Convert a katakana string to hiragana and drop spaces, so readings stay aligned with tokens."""
+    return kata_to_hira(katakana_string).replace(' ', '')
+
+def reading_field(feature_raw, missing='*'):
+    """
+    Return the reading (8th field) of a raw MeCab feature string, or `missing` if the entry has none.
+    The split stops after the reading, so the rest of the string is never broken up.
+    """
+    fields = feature_raw.split(',', 8)
+    return fields[7] if len(fields) > 7 else missing
+
+def parse_tokens(tagger, sentence, missing='*'):
+    """
+    Tokenize `sentence` with a single tagger.parse() call and yield (surface, reading) pairs.
+    Reading the text output avoids building a node object per token.
+    """
+    for line in tagger.parse(sentence).split('\n'):
+        if line == 'EOS' or not line:
+            continue
+        surface, feature_raw = line.split('\t', 1)
+        yield surface, reading_field(feature_raw, missing)
+
+def read_json(path):
+    """Load a JSON file (model or dataset) with orjson."""
+    with open(path, 'rb') as f:
+        return orjson.loads(f.read())
+
+def write_json(obj, path):
+    """Write `obj` as compact UTF-8 JSON with orjson."""
+    with open(path, 'wb') as f:
+        f.write(orjson.dumps(obj))